@@ -22,18 +22,19 @@ This script makes use of the following tools:
               possible.)
 """
 
-from __future__ import (absolute_import, division, print_function,
-                        with_statement, unicode_literals)
-
 __author__ = "Stephan Sokolow (deitarion/SSokolow)"
 __appname__ = "CD Ballooner"
 __version__ = "0.0pre0"
 __license__ = "GNU GPL 3.0 or later"
 
-import logging, multiprocessing, os, shlex, shutil, subprocess, tempfile
+import asyncio, logging, multiprocessing, os, shlex, shutil, subprocess
+import tarfile, tempfile, threading
 from collections import OrderedDict
+from contextlib import asynccontextmanager
 log = logging.getLogger(__name__)
 
+_CPU_COUNT = multiprocessing.cpu_count()
+
 GENISOFS_OPTS = [
     '-appid', __appname__,
     '-sysid', "LINUX",   # TODO: Don't hard-code this
@@ -52,9 +53,13 @@ GENISOFS_OPTS = [
 # redundancy for the filesystem structures and DVDisaster metadata.
 PAR2_CMD = ['par2', 'c', '-n1', '-r20']
 
+# Beyond this, RS02 encoding is limited by memory bandwidth, not CPU, and
+# extra threads just fight over it.
+DVDISASTER_MAX_THREADS = 8
+
 ARCHIVERS = OrderedDict([  # Sorted in priority order
     ('.zip', 'zip -rT'),
-    ('.tar', 'tar cf'),
+    ('.tar', None),  # Generated in-process by write_tarballs()
     ('.7z', '7z a -y'),
     ('.rar', 'rar a -r -rr -t -y'),
     ('.lzh', 'jlha a'),
@@ -62,122 +67,530 @@ ARCHIVERS = OrderedDict([  # Sorted in priority order
     ('.zoo', 'zoo ah'),
 ])
 
-COMPRESSORS = OrderedDict([  # Sorted in priority order
-    ('.gz', 'gzip -k'),
-    ('.bz2', 'bzip2 -k'),
-    ('.lz', 'lzip -k'),
-    ('.lzma', 'lzma -k'),
-    ('.xz', 'xz -k'),
-    #('.Z', 'compress'),  # TODO: Needs to fake -k
+# Multi-threaded implementations are listed before their serial fallbacks and
+# the first one that's installed wins. ({threads} is filled in at runtime.)
+COMPRESSOR_CANDIDATES = OrderedDict([  # Sorted in priority order
+    ('.gz', ['pigz -k -p {threads}', 'gzip -k']),
+    ('.bz2', ['pbzip2 -k -p{threads}', 'bzip2 -k']),
+    ('.lz', ['lzip -k']),
+    ('.lzma', ['lzma -k']),
+    ('.xz', ['xz -k -T{threads}']),
+    ('.zst', ['zstd -k -q -T{threads}']),
+    #('.Z', ['compress']),  # TODO: Needs to fake -k
 ])
 
+# The obsolete formats are slow, single-threaded, and add little on top of the
+# ECC from par2 and dvdisaster, so they must be asked for explicitly.
+DEFAULT_ARCHIVERS = ['.zip', '.tar', '.7z']
+DEFAULT_COMPRESSORS = ['.gz', '.xz', '.zst']
+
 EXTENSION_COMPRESSION = {
     '.tar.bz2': '.tbz2',
     '.tar.gz': '.tgz',
     '.tar.lz': '.tlz',
     '.tar.xz': '.txz',
+    '.tar.zst': '.tzst',
     #'.tar.Z': '.taZ',
 }
 
+def pick_command(candidates):
+    """Return the first command template whose executable is installed
+
+    (Falls back to the last one so a missing command fails loudly later.)
+    """
+    for command in candidates:
+        if shutil.which(shlex.split(command)[0]):
+            return command
+    return candidates[-1]
+
+COMPRESSORS = OrderedDict((ext, pick_command(candidates))
+                          for ext, candidates in COMPRESSOR_CANDIDATES.items())
+
+# Pre-split so process() doesn't have to re-parse them for every input
+ARCHIVER_ARGV = OrderedDict((ext, shlex.split(command))
+                            for ext, command in ARCHIVERS.items() if command)
+COMPRESSOR_ARGV = OrderedDict((ext, shlex.split(command))
+                              for ext, command in COMPRESSORS.items())
+
+# NOTE: `xorriso -as mkisofs` isn't a candidate because libisofs can't write
+#       the UDF TOC that GENISOFS_OPTS asks for.
+ISO_CMD = shlex.split(pick_command(['genisoimage', 'mkisofs']))
+
+def format_list(table):
+    """Make an argparse ``type`` for comma-separated, dot-less keys of ``table``
+    """
+    def parse(value):
+        from argparse import ArgumentTypeError
+        exts = ['.' + name.strip() for name in value.split(',') if name.strip()]
+        unknown = [ext for ext in exts if ext not in table]
+        if unknown:
+            raise ArgumentTypeError("Unknown format(s): {} (choose from {})"
+                .format(','.join(x[1:] for x in unknown),
+                        ','.join(x[1:] for x in table)))
+        return exts
+    return parse
+
+def positive_int(value):
+    """argparse ``type`` for integers of at least 1"""
+    from argparse import ArgumentTypeError
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ArgumentTypeError("Not a positive integer: {}".format(value))
+    return number
+
 def copy(src, dest):
-    """Copy a file or directory without caring which the source is."""
+    """Copy a file or directory without caring which the source is.
+
+    (Metadata is preserved for files the same way copytree() does for folders
+     and both use copyfile(), which lets the kernel move the bytes.)
+    """
     if os.path.isdir(src):
         shutil.copytree(src, dest)
     else:
-        shutil.copy(src, dest)
+        shutil.copy2(src, dest)
+
+def fadvise(path, advice):
+    """Give the kernel a best-effort ``posix_fadvise`` hint for a whole file
+
+    ``advice`` is the name of the constant (eg. ``'POSIX_FADV_WILLNEED'``) so
+    that this can quietly do nothing on platforms which lack the call.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+    finally:
+        os.close(fd)
+
+def forget(path):
+    """Ask the kernel to drop a file or folder's contents from the page cache
+
+    (For data which we know won't be read again, so it doesn't push out the
+     intermediate files that will be.)
+    """
+    if os.path.isdir(path):
+        for parent, _, fnames in os.walk(path):
+            for fname in fnames:
+                fpath = os.path.join(parent, fname)
+                if os.path.isfile(fpath):
+                    fadvise(fpath, 'POSIX_FADV_DONTNEED')
+    else:
+        fadvise(path, 'POSIX_FADV_DONTNEED')
+
+_GRAFT_TABLE = str.maketrans({'\\': '\\\\', '=': '\\='})
 
 def escape_graft(path):
     """Escape an unescaped path for use with a -graft-points
 
     WARNING: Must be applied before adding the significant '='
     """
-    return path.replace('\\', '\\\\').replace('=', '\\=')
+    return path.translate(_GRAFT_TABLE)
 
-def parchive(src_path):
-    """Generate a maximum-redundancy .par2 archive for the source path
+class JobLimit(object):
+    """A semaphore which can also hand out several slots at once
 
-    (It will be placed in the same parent directory)"""
-    par_dir, src_name = os.path.split(src_path)
+    (Taking them one by one could deadlock two multi-slot holders which each
+     got part of what they need.)
+    """
+    def __init__(self, slots):
+        self.slots = slots
+        self._semaphore = asyncio.Semaphore(slots)
+        self._multi_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def hold(self, count):
+        """Hold ``count`` slots (capped at the total) for a ``with`` block"""
+        count, acquired = min(count, self.slots), 0
+        try:
+            async with self._multi_lock:
+                while acquired < count:
+                    await self._semaphore.acquire()
+                    acquired += 1
+            yield
+        finally:
+            for _ in range(acquired):
+                self._semaphore.release()
+
+async def run(argv, cwd, limit):
+    """Run a command in ``cwd`` as soon as the :class:`JobLimit` allows it
+
+    Raises :class:`subprocess.CalledProcessError` on a nonzero exit code.
+    """
+    async with limit:
+        log.debug("Running in %r: %s", cwd,
+                  ' '.join(shlex.quote(arg) for arg in argv))
+        spawn = asyncio.ensure_future(
+            asyncio.create_subprocess_exec(*argv, cwd=cwd))
+        try:
+            proc = await asyncio.shield(spawn)
+            retcode = await proc.wait()
+        except asyncio.CancelledError:
+            # Don't leave orphans writing into a temp_dir that's being removed
+            # (The spawn is shielded because cancelling it part-way can hang
+            #  and would leave us without a child to kill.)
+            await wait_out([spawn])
+            if not spawn.cancelled() and not spawn.exception():
+                proc = spawn.result()
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass  # Already exited and reaped
+                await wait_out([asyncio.ensure_future(proc.wait())])
+            raise
+
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, argv)
+
+async def wait_out(futures):
+    """Wait for all of ``futures`` to finish, even if we get cancelled again
+
+    (For cleanup code which is already on its way out with an exception.)
+    """
+    pending = set(futures)
+    while pending:
+        try:
+            _, pending = await asyncio.wait(pending)
+        except asyncio.CancelledError:
+            pass
+
+async def gather(*aws):
+    """Like :func:`asyncio.gather` but, if anything fails, cancel the rest and
+    wait for them to wind down before passing the exception on.
+
+    (Otherwise, they'd be left running, and asyncio.run() would cancel them at
+     shutdown, after we've started removing the temp_dir out from under them.)
+
+    Each task is cancelled at most once, since a second cancellation could
+    interrupt the cleanup that the first one triggered.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    if not tasks:
+        return []
 
-    if os.path.isdir(src_path):
-        files = []
-        for parent, _, fnames in os.walk(src_path):
-            files.extend(os.path.join(parent, fname) for fname in fnames)
-        files = [os.path.relpath(path, par_dir) for path in files]
-        subprocess.check_call(PAR2_CMD + [src_path + '.par2'] + files,
-                              cwd=par_dir)
+    try:
+        _, pending = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_EXCEPTION)
+    except asyncio.CancelledError:
+        pending = tasks
+        raise
+    finally:
+        for task in pending:
+            task.cancel()
+        await wait_out(pending)
+
+    for task in tasks:
+        if not task.cancelled() and task.exception():
+            raise task.exception()
+    return [task.result() for task in tasks]
+
+async def parchive(par_dir, set_name, names, limit, threads=1):
+    """Generate one maximum-redundancy .par2 set covering several paths
+
+    ``names`` are relative to ``par_dir`` (where the set will be placed) and
+    folders are recursed into by par2 itself, so the command line stays short
+    no matter how many files they contain."""
+    log.info("Applying par2 to %r", names)
+    set_path = os.path.join(par_dir, set_name + '.par2')
+    await run(PAR2_CMD + ['-R', '-t' + str(threads), set_path] + names,
+              par_dir, limit)
+
+class _Tee(object):
+    """Write-only file-like object which copies everything to several others
+
+    Raises :class:`InterruptedError` once the ``stop`` event has been set.
+    """
+    def __init__(self, targets, stop):
+        self.targets = targets
+        self.stop = stop
+
+    def write(self, data):
+        if self.stop.is_set():
+            raise InterruptedError("Tarball generation cancelled")
+
+        data = memoryview(data)
+        for target in self.targets:
+            # Unbuffered pipes are allowed to accept only part of a write
+            remaining = data
+            while remaining:
+                remaining = remaining[target.write(remaining):]
+        return len(data)
+
+def _write_tarballs(src_path, compressors, stop):
+    """Synchronous implementation of :func:`write_tarballs`"""
+    src_dir, src_name = os.path.split(src_path)
+    streams, procs = [], []
+    try:
+        streams.append(open(src_path + '.tar', 'wb'))
+        for ext, compressor in compressors.items():
+            ext = '.tar' + ext
+            dest = src_path + EXTENSION_COMPRESSION.get(ext, ext)
+            log.info("Compressing %r with %r", src_name + '.tar',
+                     compressor[0])
+
+            argv = compressor + ['-c']
+            with open(dest, 'wb') as outfile:
+                # Unbuffered so close() can't raise if a compressor died
+                proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                    stdout=outfile, cwd=src_dir, bufsize=0)
+            procs.append((argv, proc))
+            streams.append(proc.stdin)
+
+        # GNU format to match what `tar cf` produced (and old tools expect)
+        with tarfile.open(fileobj=_Tee(streams, stop), mode='w|',
+                          format=tarfile.GNU_FORMAT) as tar:
+            tar.add(src_path, arcname=src_name)
+    except BrokenPipeError as err:
+        broken_pipe = err  # Prefer reporting which compressor died
     else:
-        subprocess.check_call(PAR2_CMD + [src_path + '.par2', src_name],
-                              cwd=par_dir)
+        broken_pipe = None
+    finally:
+        if stop.is_set():
+            for _, proc in procs:
+                proc.kill()
+        for stream in streams:
+            stream.close()
+        retcodes = [(argv, proc.wait()) for argv, proc in procs]
+
+    for argv, retcode in retcodes:
+        if retcode:
+            raise subprocess.CalledProcessError(retcode, argv)
+    if broken_pipe:
+        raise broken_pipe
+
+async def write_tarballs(src_path, compressors, limit):
+    """Write ``src_path + '.tar'`` and every compressed form of it in one pass
+
+    Rather than writing the .tar to disk and then having each compressor read
+    it back, a single in-process tar stream is fed to the file and to the
+    stdin of every compressor in ``compressors`` (a dict mapping extensions
+    to argument lists) at the same time.
+
+    (One ``limit`` slot is held for each compressor until they've all exited,
+     even if this gets cancelled.)
+    """
+    stop = threading.Event()
+    async with limit.hold(max(1, len(compressors))):
+        future = asyncio.get_running_loop().run_in_executor(
+            None, _write_tarballs, src_path, compressors, stop)
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            stop.set()
+            await wait_out([future])
+            future.exception()  # Expected to be the InterruptedError
+            raise
 
 # TODO: Redesign this so it does format-by-format iteration so that, if there's
 # enough data to actually fill the disc with the help of this process, there
 # won't be an unequal distribution of redundancy.
-def process(inpath, outdir):
-    outdir = os.path.abspath(outdir)
+async def process(inpath, outdir, limit, threads=1,
+                  archivers=DEFAULT_ARCHIVERS, compressors=DEFAULT_COMPRESSORS):
     outname = os.path.basename(inpath)
     outpath = os.path.join(outdir, outname)
     log.info("Processing %r -> %r", inpath, outdir)
 
     log.info("Copying %r -> %r", inpath, outpath)
-    copy(inpath, outpath)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, copy, inpath, outpath)
+
+    # Everything after this point reads the copy rather than the original
+    await loop.run_in_executor(None, forget, inpath)
+
+    # Every archiver and compressor reads the same (unchanging) copy and
+    # writes its own output file, so they can all run at once.
+    #
+    # NOTE: Don't be tempted to fold these into one generated `sh -c` script
+    #       per input. The shell still forks once per command, `wait` throws
+    #       away their exit codes, and the jobs would escape `limit`.
+    tasks, existing = [], set(os.listdir(outdir))
+    for ext, archiver in ARCHIVER_ARGV.items():
+        if ext not in archivers:
+            continue
 
-    for ext, archiver in ARCHIVERS.items():
         archive_path = outpath + ext
-        if os.path.exists(archive_path):
-            log.info("Skipping. Already exists: %s", archive_path)
-        else:
-            log.info("Archiving %r -> %r", inpath, archive_path)
+        if outname + ext in existing:
+            raise FileExistsError("Already exists: {}".format(archive_path))
 
-        # TODO: Handle nonzero return codes and missing commands
-        argv = shlex.split(archiver) + [archive_path, os.path.basename(inpath)]
-        subprocess.check_call(argv, cwd=outdir)
+        log.info("Archiving %r -> %r", inpath, archive_path)
+        # TODO: Handle missing commands
+        tasks.append(run(archiver + [archive_path, outname], outdir, limit))
 
-    for ext, compressor in COMPRESSORS.items():
-        if os.path.isfile(outpath):
-            log.info("Compressing %r with %r", inpath, compressor)
-            argv = shlex.split(compressor) + [outpath]
-            subprocess.check_call(argv, cwd=outdir)
+    compressor_argvs = OrderedDict(
+        (ext, [arg.format(threads=threads) for arg in compressor])
+        for ext, compressor in COMPRESSOR_ARGV.items() if ext in compressors)
+    if os.path.isfile(outpath):
+        for compressor in compressor_argvs.values():
+            log.info("Compressing %r with %r", inpath, compressor[0])
+            tasks.append(run(compressor + [outpath], outdir, limit))
 
-        out_tar = outname + '.tar'
-        log.info("Compressing %r with %r", out_tar, compressor)
-        argv = shlex.split(compressor) + [out_tar]
-        subprocess.check_call(argv, cwd=outdir)
+    if '.tar' in archivers:
+        if outname + '.tar' in existing:
+            raise FileExistsError("Already exists: {}".format(
+                outpath + '.tar'))
 
-    for ext_from, ext_to in EXTENSION_COMPRESSION.items():
-        src = outpath + ext_from
-        dest = outpath + ext_to
-        os.rename(src, dest)
+        log.info("Archiving %r -> %r", inpath, outpath + '.tar')
+        tasks.append(write_tarballs(outpath, compressor_argvs, limit))
+    await gather(*tasks)
 
-def generate_iso(src_dir, outpath, volume_id):
-    src_dir = os.path.abspath(src_dir)
+async def balloon(inpaths, outdir, threads=1,
+                  archivers=DEFAULT_ARCHIVERS, compressors=DEFAULT_COMPRESSORS):
+    """Copy, archive, compress, and par2 ``inpaths`` into ``outdir``
+
+    (``outdir`` must be an absolute path.)
+
+    No more than one subprocess per core is allowed to run at any given time.
+    """
+    cores = _CPU_COUNT
+    limit = JobLimit(cores)
+
+    # Each input gets its own names inside outdir, so the archivers and
+    # compressors for different inputs can safely run side by side.
+    await gather(*[
+        process(path, outdir, limit, threads, archivers, compressors)
+        for path in inpaths])
+
+    # Give each input a single .par2 set covering its copy and all of the
+    # archives made from it rather than paying par2's startup costs per file
+    groups = OrderedDict((os.path.basename(path), []) for path in inpaths)
+    with os.scandir(outdir) as entries:
+        for entry in entries:
+            fname = entry.name
+            if fname.endswith('.par2'):
+                log.debug("Not generating .par2.par2: %r", fname)
+                continue
+
+            owner = max((name for name in groups
+                         if fname == name or fname.startswith(name + '.')),
+                        key=len)
+            groups[owner].append(fname)
+
+    # par2 only partially uses the cores it's given, so run several at
+    # once and split the cores between them.
+    if groups:
+        par2_threads = max(1, cores // min(cores, len(groups)))
+        await gather(*[
+            parchive(outdir, name, names, limit, par2_threads)
+            for name, names in groups.items()])
+
+def output_names(inpath, archivers, compressors):
+    """Return the names that :func:`process` and :func:`parchive` will create
+    in the output folder for ``inpath``
+
+    (Apart from the ``.volNN+NN.par2`` recovery volumes, whose names depend on
+     how par2 decides to split the recovery data.)
+    """
+    name = os.path.basename(inpath)
+    names = [name, name + '.par2']
+    names.extend(name + ext for ext in archivers)
+    if '.tar' in archivers:
+        for ext in compressors:
+            ext = '.tar' + ext
+            names.append(name + EXTENSION_COMPRESSION.get(ext, ext))
+    if os.path.isfile(inpath):
+        names.extend(name + ext for ext in compressors)
+    return names
+
+def check_collisions(inpaths, archivers, compressors):
+    """Raise :class:`ValueError` if any two of ``inpaths`` would write to the
+    same name in the output folder
+
+    Inputs are processed concurrently, so any overlap would be a race. Names
+    are compared case-insensitively, since that's how Joliet gets read.
+    """
+    owners = {}
+    for path in inpaths:
+        if not os.path.basename(path):
+            raise ValueError("Cannot use a filesystem root as input: {}"
+                             .format(path))
+        for name in output_names(path, archivers, compressors):
+            owner = owners.setdefault(name.casefold(), path)
+            if owner != path:
+                raise ValueError("Inputs would collide as {!r}: {} and {}"
+                                 .format(name, owner, path))
+
+    for path in inpaths:
+        prefix = os.path.basename(path).casefold() + '.vol'
+        for name, owner in owners.items():
+            if (owner != path and name.startswith(prefix) and
+                    name.endswith('.par2')):
+                raise ValueError("{} would collide with the par2 recovery "
+                                 "volumes for {}".format(owner, path))
+
+def pick_scratch_dir(inpaths, fallback, formats, candidate='/dev/shm'):
+    """Return ``candidate`` if it has room for all of the intermediate files
+    that will be generated from ``inpaths``. Otherwise, return ``fallback``.
+
+    (Assumes the worst case of each of the ``formats`` archive/compression
+     outputs being as large as the input.)
+    """
+    # copytree() and copy2() follow symlinks, so this has to as well
+    total = 0
+    for path in inpaths:
+        if os.path.isdir(path):
+            for parent, _, fnames in os.walk(path, followlinks=True):
+                total += sum(os.stat(os.path.join(parent, fname)).st_size
+                             for fname in fnames)
+        else:
+            total += os.path.getsize(path)
 
-    grafts_seen, grafts = [], []
-    for fname in os.listdir(src_dir):
-        name = escape_graft(fname)
-        path = escape_graft(os.path.join(src_dir, fname))
+    # The copy, the archives and compressed files, and the par2 set
+    needed = int(total * (1 + formats) * 1.2)
 
-        assert name not in grafts_seen, "Naming collision: {}".format(name)
-        grafts_seen.append(name)
-        grafts.append(name + '=' + path)
+    try:
+        stat = os.statvfs(candidate)
+    except OSError:
+        return fallback
+
+    if stat.f_bavail * stat.f_frsize >= needed:
+        return candidate
+    return fallback
+
+def generate_iso(src_dir, outpath, volume_id):
+    """Build an ECC-augmented ISO from the contents of ``src_dir``
 
-    subprocess.check_call(['genisoimage'] + GENISOFS_OPTS +
+    (``src_dir`` must be an absolute path.)
+    """
+    names = [escape_graft(fname) for fname in os.listdir(src_dir)]
+    # Joliet is case-insensitive in practice, so names differing only in
+    # case would clobber each other for anyone reading the disc that way
+    grafts_seen = {}
+    for name in names:
+        folded = name.casefold()
+        if folded in grafts_seen:
+            raise ValueError("Naming collision: {} vs. {}".format(
+                grafts_seen[folded], name))
+        grafts_seen[folded] = name
+
+    prefix = escape_graft(src_dir + os.sep)
+    grafts = [name + '=' + prefix + name for name in names]
+
+    subprocess.check_call(ISO_CMD + GENISOFS_OPTS +
         ['-volid', volume_id, '-o', outpath, '-graft-points'] + grafts)
 
-    cores = multiprocessing.cpu_count()
-    subprocess.check_call(['dvdisaster', '-c', '-x', str(cores),
+    # dvdisaster augments the image in place, so it can't be fed from a pipe,
+    # but we can at least ask for it to be read back from the page cache.
+    fadvise(outpath, 'POSIX_FADV_WILLNEED')
+
+    threads = min(_CPU_COUNT, DVDISASTER_MAX_THREADS)
+    subprocess.check_call(['dvdisaster', '-c', '-x', str(threads),
         '-mRS02', '-n', 'CD', '-i', outpath])
 
+    # We're done with it, so don't let it push more useful things out
+    fadvise(outpath, 'POSIX_FADV_DONTNEED')
+
 def main():
     """The main entry point, compatible with setuptools entry points."""
-    # If we're running on Python 2, take responsibility for preventing
-    # output from causing UnicodeEncodeErrors. (Done here so it should only
-    # happen when not being imported by some other program.)
-    import sys
-    if sys.version_info.major < 3:
-        reload(sys)
-        sys.setdefaultencoding('utf-8')  # pylint: disable=no-member
-
     from argparse import ArgumentParser, RawDescriptionHelpFormatter
     parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
             description=__doc__.replace('\r\n', '\n').split('\n--snip--\n')[0])
@@ -194,6 +607,25 @@ def main():
         "the first 32 characters of the first file's name)")
     parser.add_argument('-o', '--outpath', default='./output.iso',
         help="Name of the ISO to generate. (default: %(default)s)")
+    parser.add_argument('--scratch-dir', default=None,
+        help="Where to build the intermediate files. (default: /dev/shm if "
+        "it has enough free space, otherwise the folder containing the ISO)")
+    parser.add_argument('--archivers', type=format_list(ARCHIVERS),
+        default=','.join(ext[1:] for ext in DEFAULT_ARCHIVERS),
+        help="Comma-separated list of archive formats to generate. (choices: "
+        "{}) (default: %(default)s)".format(
+            ','.join(ext[1:] for ext in ARCHIVERS)))
+    parser.add_argument('--compressors', type=format_list(COMPRESSORS),
+        default=','.join(ext[1:] for ext in DEFAULT_COMPRESSORS),
+        help="Comma-separated list of compression formats to apply to single "
+        "files and the .tar archive. (choices: {}) (default: %(default)s)"
+        .format(','.join(ext[1:] for ext in COMPRESSORS)))
+    parser.add_argument('--threads', type=positive_int, default=None,
+        help="Number of threads to request from each multi-threaded "
+        "compressor. Since several compressors already run at once, raising "
+        "this mainly helps when there are few of them and can otherwise "
+        "oversubscribe the CPU. (default: the number of cores divided by the "
+        "number of compressors which may run concurrently)")
     # Reminder: %(default)s can be used in help strings.
 
     args = parser.parse_args()
@@ -207,27 +639,44 @@ def main():
                         format='%(levelname)s: %(message)s')
 
     # TODO: Split all this out into its own function
-    out_parent = os.path.dirname(os.path.abspath(args.outpath))
-    temp_dir = tempfile.mkdtemp(prefix='balloon_cd-', dir=out_parent)
-    try:
-        for path in args.inpath:
-            if not os.path.exists(path):
-                log.warning("Input path does not exist: %s", path)
-                continue
-
-            process(path, temp_dir)
+    inpaths = []
+    for path in args.inpath:
+        if os.path.exists(path):
+            # abspath() strips trailing slashes that'd make basename() empty
+            inpaths.append(os.path.abspath(path))
+        else:
+            log.warning("Input path does not exist: %s", path)
+    if not inpaths:
+        parser.error("None of the input paths exist")
 
-        for fname in sorted(os.listdir(temp_dir)):
-            temp_path = os.path.join(temp_dir, fname)
-            if temp_path.endswith('.par2'):
-                log.debug("Not generating .par2.par2: %r", temp_path)
-            else:
-                log.info("Applying par2 to %r", temp_path)
-                parchive(temp_path)
+    try:
+        check_collisions(inpaths, args.archivers, args.compressors)
+    except ValueError as err:
+        parser.error(str(err))
+
+    if args.threads is None:
+        # Count the compressor jobs that will actually run: one per format for
+        # each .tar and one per format for each single-file input
+        tarballs = len(inpaths) if '.tar' in args.archivers else 0
+        files = sum(1 for path in inpaths if os.path.isfile(path))
+        jobs = max(1, (tarballs + files) * len(args.compressors))
+        args.threads = max(1, _CPU_COUNT // min(_CPU_COUNT, jobs))
+
+    scratch_dir = args.scratch_dir
+    if not scratch_dir:
+        out_parent = os.path.dirname(os.path.abspath(args.outpath))
+        scratch_dir = pick_scratch_dir(inpaths, out_parent,
+            len(args.archivers) + 2 * len(args.compressors))
+
+    temp_dir = os.path.abspath(
+        tempfile.mkdtemp(prefix='balloon_cd-', dir=scratch_dir))
+    try:
+        asyncio.run(balloon(inpaths, temp_dir, args.threads,
+                            args.archivers, args.compressors))
 
         volume_id = args.volid
         if not volume_id:
-            volume_id = os.path.basename(args.inpath[0])[:32]
+            volume_id = os.path.basename(inpaths[0])[:32]
 
         generate_iso(temp_dir, args.outpath, volume_id)
     finally: